@@ -1,10 +1,13 @@
 import os
 import re
-import json
+import asyncio
 import logging
-import bleach
-import requests
+import functools
+import threading
+import httpx
+import orjson
 from dotenv import load_dotenv
+from util import sanitize_input
 
 load_dotenv()
 
@@ -15,158 +18,327 @@ OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# One pooled HTTP/2 client per process - cap connections so a burst can't exhaust ports
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
 # Initialize API clients
 if OPENROUTER_API_KEY:
     import openai
-    import httpx
-    openrouter_client = openai.OpenAI(
+    async_client = openai.AsyncOpenAI(
         base_url="https://openrouter.ai/api/v1",
         api_key=OPENROUTER_API_KEY,
-        http_client=httpx.Client()
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
     )
     API_TYPE = 'openrouter'
     print("Using Gemini 2.5 Flash via OpenRouter")
 elif OPENAI_API_KEY:
     import openai
-    openai.api_key = OPENAI_API_KEY
+    async_client = openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+    )
     API_TYPE = 'openai'
     print("Using OpenAI GPT-4o-mini")
 elif GEMINI_API_KEY:
+    async_client = httpx.AsyncClient(
+        timeout=60,
+        # Reuse keep-alive connections and retry failed connects
+        transport=httpx.AsyncHTTPTransport(http2=True, retries=2, limits=HTTP_LIMITS)
+    )
     API_TYPE = 'gemini'
     API_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:generateContent'
+    # Same model, sent as server-sent events while it generates
+    STREAM_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-exp:streamGenerateContent?alt=sse'
+    # Batch Mode is half price and latency-tolerant - used for background preloads only
+    BATCH_URL = 'https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:batchGenerateContent'
+    BATCH_STATUS_URL = 'https://generativelanguage.googleapis.com/v1beta/{name}'
+    # Statuses Gemini sheds load with - worth a quick retry
+    RETRY_STATUSES = (429, 502, 503, 504)
+    GEMINI_HEADERS = {
+        'Content-Type': 'application/json',
+        'X-goog-api-key': GEMINI_API_KEY
+    }
+    # Everything in a generateContent body except the prompt, already serialized
+    _GEMINI_BODY_PRE = b'{"contents":[{"parts":[{"text":'
+    _GEMINI_BODY_POST = b'}]}]}'
     print("Using Gemini 2.5 Flash")
 else:
     raise ValueError("No API key found. Please set either OPENROUTER_API_KEY, OPENAI_API_KEY, or GEMINI_API_KEY in your .env file")
 
-def sanitize_input(text):
-    """Sanitize user input to prevent XSS attacks"""
-    if not text:
-        return ""
-    # Remove any potentially dangerous characters and HTML tags
-    cleaned = bleach.clean(text, tags=[], attributes={}, strip=True)
-    # Additional safety: remove any remaining script-like content
-    cleaned = re.sub(r'<script[^>]*>.*?</script>', '', cleaned, flags=re.IGNORECASE | re.DOTALL)
-    cleaned = re.sub(r'javascript:', '', cleaned, flags=re.IGNORECASE)
-    return cleaned.strip()
+# Background event loop that owns the async clients - all provider I/O runs here
+# so generations overlap on the wire and share one connection pool
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name='ai-loop', daemon=True).start()
+
+def run_async(coro):
+    """Schedule a coroutine on the background event loop and return its future"""
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+def _iterate_async(agen):
+    """Drive an async generator on the background loop from a request thread"""
+    try:
+        while True:
+            try:
+                yield run_async(agen.__anext__()).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        # Client went away mid-stream - close the provider stream too
+        run_async(agen.aclose())
+
+# Patterns used on every generation - compiled once at import
+# Markdown code fences the model sometimes wraps its HTML in
+_FENCE_RE = re.compile(r'```(?:html)?')
+# Links in the format href="./path" - must start with ./
+# Length, quote and whitespace limits live in the pattern so malformed links never reach Python
+_HREF_RE = re.compile(r'href=["\']\./([^"\'\s]{1,100})["\']', re.IGNORECASE)
 
 def extract_navigation_links(content, current_path=""):
     """Extract navigation links from generated content"""
-    links = []
-    # Look for links in the format href="./path" - must start with ./
-    link_patterns = [
-        r'href=["\']\./(.*?)["\']',
-    ]
-    
-    for pattern in link_patterns:
-        matches = re.findall(pattern, content, re.IGNORECASE)
-        for match in matches:
-            if match and match not in links and not match.startswith('http') and 'favicon' not in match:
-                # Clean up the link
-                clean_link = match.strip('/')
-                
-                # Remove any duplicated path segments completely
-                path_parts = clean_link.split('/')
-                unique_parts = []
-                seen_parts = set()
-                
-                for part in path_parts:
-                    if part not in seen_parts:
-                        unique_parts.append(part)
-                        seen_parts.add(part)
-                
-                clean_link = '/'.join(unique_parts)
-                
-                # Allow deeper paths but prevent exact word repetition
-                # Split current path and link path into words
-                current_words = set(word.lower() for word in current_path.split('/') if word) if current_path else set()
-                link_words = [word.lower() for word in clean_link.split('/') if word]
-                
-                # Check if any word from current path appears in the link
-                has_repeated_words = any(word in current_words for word in link_words)
-                
-                # Allow paths up to 4 levels deep, no repeated words from current path
-                if (clean_link and len(clean_link) < 50 and '.' not in clean_link and 
-                    clean_link.count('/') < 4 and not has_repeated_words):
-                    links.append(clean_link)
+    # Words from the current path must not be repeated in its links
+    current_words = frozenset(word.lower() for word in current_path.split('/') if word) if current_path else frozenset()
     
-    # Ensure we never return more than 5 links
-    unique_links = list(set(links))
-    return unique_links[:5]
-
-def generate_content_with_ai(path_info):
-    """Generate HTML content using AI"""
-    # Load prompt from JSON
-    with open('prompts.json', 'r') as f:
-        prompts = json.load(f)
+    # Insertion-ordered set of accepted links
+    links = {}
+    for match in _HREF_RE.findall(content):
+        if match.startswith('http') or 'favicon' in match:
+            continue
+        
+        # Clean up the link and remove any duplicated path segments completely
+        clean_link = '/'.join(dict.fromkeys(match.strip('/').split('/')))
+        
+        # Allow deeper paths but prevent exact word repetition
+        has_repeated_words = any(word.lower() in current_words for word in clean_link.split('/') if word)
+        
+        # Allow paths up to 4 levels deep, no repeated words from current path
+        if (clean_link and len(clean_link) < 50 and '.' not in clean_link and 
+            clean_link.count('/') < 4 and not has_repeated_words):
+            links.setdefault(clean_link, None)
+            # Ensure we never return more than 5 links
+            if len(links) == 5:
+                break
     
-    base_prompt_lines = prompts['base_prompt']
+    return list(links)
+
+@functools.lru_cache(maxsize=1)
+def _load_prompts():
+    """Load prompts.json once - it is static for the life of the process"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts.json'), 'rb') as f:
+        return orjson.loads(f.read())
+
+# Join lines once
+_BASE_PROMPT = "\n".join(_load_prompts()['base_prompt'])
+
+# Every home page visit uses the same prompt
+_HOME_PROMPT = _BASE_PROMPT.format(topic_text=" about any interesting topic you choose",
+                                   nav_format="./topic/subtopic", current_path="HOME")
+
+def build_prompt(path_info):
+    """Build the generation prompt for a path"""
+    if not (path_info and path_info.strip('/')):
+        return _HOME_PROMPT
+    return _BASE_PROMPT.format(topic_text=f" about '{path_info}'", nav_format=f"./{path_info}/subtopic",
+                               current_path=path_info)
+
+# Shown when a generation fails
+UNAVAILABLE_HTML = "<h1>Service Temporarily Unavailable</h1><p>Our website is currently overloaded with requests. Please try again later.</p>"
+
+def clean_content(content):
+    """Clean up any markdown formatting around the generated HTML"""
+    return _FENCE_RE.sub('', content).strip()
+
+def _gemini_body(prompt):
+    """Serialize a generateContent body - only the prompt is encoded per call"""
+    return _GEMINI_BODY_PRE + orjson.dumps(prompt) + _GEMINI_BODY_POST
+
+async def _gemini_post(url, content):
+    """POST a serialized JSON body to Gemini, retrying briefly when it sheds load"""
+    for attempt in range(3):
+        response = await async_client.post(url, headers=GEMINI_HEADERS, content=content)
+        if response.status_code not in RETRY_STATUSES or attempt == 2:
+            break
+        await asyncio.sleep(0.2 * 2 ** attempt)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+async def _stream_chunks(prompt):
+    """Yield raw content chunks from the configured provider as they arrive"""
+    if API_TYPE == 'gemini':
+        body = _gemini_body(prompt)
+        for attempt in range(3):
+            async with async_client.stream('POST', STREAM_URL, headers=GEMINI_HEADERS, content=body) as response:
+                # Nothing has been sent yet, so load shedding is still safe to retry
+                if response.status_code in RETRY_STATUSES and attempt < 2:
+                    await asyncio.sleep(0.2 * 2 ** attempt)
+                    continue
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith('data:'):
+                        continue
+                    # The final event may carry only finishReason and no content
+                    for candidate in orjson.loads(line[5:]).get('candidates', [])[:1]:
+                        for part in candidate.get('content', {}).get('parts', []):
+                            if part.get('text'):
+                                yield part['text']
+                return
     
-    if path_info and path_info.strip('/'):
-        topic_text = f" about '{path_info}'"
-        nav_format = f"./{path_info}/subtopic"
-        current_path = path_info
+    if API_TYPE == 'openrouter':
+        stream = await async_client.chat.completions.create(
+            model="google/gemini-2.5-flash",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            timeout=15,  # 15 second timeout
+            stream=True
+        )
     else:
-        topic_text = " about any interesting topic you choose"
-        nav_format = "./topic/subtopic"
-        current_path = "HOME"
+        stream = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=16000,
+            stream=True
+        )
     
-    # Join lines and format
-    base_prompt = "\n".join(base_prompt_lines)
-    prompt = base_prompt.format(topic_text=topic_text, nav_format=nav_format, current_path=current_path)
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def _strip_fences(chunks):
+    """Remove markdown fences from streamed content, even when a fence is split across chunks"""
+    fence = '```html'
+    pending = ''
+    started = False
+    async for chunk in chunks:
+        pending += chunk
+        # Hold back a tail that could be the start of a fence
+        hold = next((k for k in range(min(len(fence) - 1, len(pending)), 0, -1) if pending.endswith(fence[:k])), 0)
+        text = _FENCE_RE.sub('', pending[:len(pending) - hold])
+        pending = pending[len(pending) - hold:]
+        if not started:
+            text = text.lstrip()
+        if text:
+            started = True
+            yield text
+    
+    text = _FENCE_RE.sub('', pending)
+    if not started:
+        text = text.lstrip()
+    if text:
+        yield text
+
+async def stream_content_async(path_info):
+    """Generate HTML content using AI on the background event loop, yielding it as the provider streams it back"""
+    prompt = build_prompt(path_info)
     
     # Sanitize the path_info to prevent injection attacks
     safe_path_info = sanitize_input(path_info) if path_info else ""
     
     try:
-        logger.info(f"GENERATING: {safe_path_info or 'HOME'}")
-        if API_TYPE == 'openrouter':
-            response = openrouter_client.chat.completions.create(
-                model="google/gemini-2.5-flash",
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                timeout=15  # 15 second timeout
-            )
-            content = response.choices[0].message.content
-            logger.info(f"COMPLETED: {safe_path_info or 'HOME'} ({len(content)} chars)")
-            
-        elif API_TYPE == 'openai':
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=16000
-            )
-            content = response.choices[0].message.content
-            
-        elif API_TYPE == 'gemini':
-            response = requests.post(
-                API_URL,
-                headers={
-                    'Content-Type': 'application/json',
-                    'X-goog-api-key': GEMINI_API_KEY
-                },
-                json={
-                    'contents': [{
-                        'parts': [{
-                            'text': prompt
-                        }]
-                    }]
-                }
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                content = data['candidates'][0]['content']['parts'][0]['text']
-            else:
-                return "<h1>Service Temporarily Unavailable</h1><p>Our website is currently overloaded with requests. Please try again in a few minutes.</p><p>We appreciate your patience!</p>"
+        logger.info("GENERATING: %s", safe_path_info or 'HOME')
+        length = 0
+        async for chunk in _strip_fences(_stream_chunks(prompt)):
+            length += len(chunk)
+            yield chunk
+        logger.info("COMPLETED: %s (%d chars)", safe_path_info or 'HOME', length)
         
-        # Clean up any markdown formatting
-        content = content.replace('```html', '').replace('```', '').strip()
-        return content
+    except Exception as e:
+        logger.error("GENERATION FAILED for %s: %s", safe_path_info, e)
+        raise
+
+def stream_content_with_ai(path_info):
+    """Generate HTML content using AI, yielding it to a request thread as the provider streams it back"""
+    return _iterate_async(stream_content_async(path_info))
+
+async def _generate_async(prompt):
+    """Send a prompt to the configured provider without blocking a thread"""
+    if API_TYPE == 'openrouter':
+        response = await async_client.chat.completions.create(
+            model="google/gemini-2.5-flash",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.7,
+            timeout=15  # 15 second timeout
+        )
+        return response.choices[0].message.content
+    
+    if API_TYPE == 'openai':
+        response = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=16000
+        )
+        return response.choices[0].message.content
+    
+    data = await _gemini_post(API_URL, _gemini_body(prompt))
+    return data['candidates'][0]['content']['parts'][0]['text']
+
+async def generate_content_async(path_info):
+    """Generate HTML content using AI on the background event loop - raises on failure so it is never cached"""
+    safe_path_info = sanitize_input(path_info) if path_info else ""
+    
+    try:
+        logger.info("GENERATING: %s", safe_path_info or 'HOME')
+        content = await _generate_async(build_prompt(path_info))
+        logger.info("COMPLETED: %s (%d chars)", safe_path_info or 'HOME', len(content))
+        return clean_content(content)
         
     except Exception as e:
-        logger.error(f"GENERATION FAILED for {safe_path_info}: {str(e)}")
-        return "<h1>Service Temporarily Unavailable</h1><p>Our website is currently overloaded with requests. Please try again later.</p>"
\ No newline at end of file
+        logger.error("GENERATION FAILED for %s: %s", safe_path_info, e)
+        raise
+
+async def submit_batch_async(paths):
+    """Submit prompts for several paths as one Gemini batch job and return the job name"""
+    data = await _gemini_post(BATCH_URL, orjson.dumps({
+        'batch': {
+            'display_name': 'infinite-web-preload',
+            'input_config': {
+                'requests': {
+                    'requests': [{
+                        'request': {
+                            'contents': [{
+                                'parts': [{
+                                    'text': build_prompt(path_info)
+                                }]
+                            }]
+                        },
+                        'metadata': {'key': path_info}
+                    } for path_info in paths]
+                }
+            }
+        }
+    }))
+    return data['name']
+
+async def get_batch_results_async(name):
+    """Return {path: content} for a finished batch job, or None while it is still running"""
+    response = await async_client.get(
+        BATCH_STATUS_URL.format(name=name),
+        headers={'X-goog-api-key': GEMINI_API_KEY}
+    )
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    
+    state = data.get('metadata', {}).get('state')
+    if state in ('BATCH_STATE_PENDING', 'BATCH_STATE_RUNNING'):
+        return None
+    if state != 'BATCH_STATE_SUCCEEDED':
+        logger.error("BATCH %s ENDED: %s", name, state)
+        return {}
+    
+    results = {}
+    for item in data.get('response', {}).get('inlinedResponses', {}).get('inlinedResponses', []):
+        path_info = item.get('metadata', {}).get('key')
+        try:
+            content = item['response']['candidates'][0]['content']['parts'][0]['text']
+        except (KeyError, IndexError):
+            logger.error("BATCH %s MISSING RESULT: %s", name, path_info)
+            continue
+        if path_info:
+            results[path_info] = clean_content(content)
+    return results
\ No newline at end of file
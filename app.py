@@ -1,15 +1,25 @@
-from flask import Flask, render_template, request, make_response
+from flask import Flask, render_template, request, make_response, Response, stream_with_context, g
 import os
+import gzip
+import time
 import logging
+import functools
+import threading
 from dotenv import load_dotenv
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
-from ai_service import generate_content_with_ai, sanitize_input
-from cache_service import get_cached_content, wait_for_preload, start_preloading
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib.parse import quote
+from ai_service import stream_content_with_ai, UNAVAILABLE_HTML
+from util import sanitize_path, is_full_document
+from cache_service import (get_cached_content, wait_for_preload, is_preloading, claim_generation,
+                           generate_and_cache, start_preloading)
 
 load_dotenv()
 
 app = Flask(__name__)
+# Trust one proxy hop for X-Forwarded-For/Proto so remote_addr is the client
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1)
 
 # Configure logging - hide noisy logs
 logging.basicConfig(level=logging.INFO)
@@ -18,118 +28,247 @@ logger = logging.getLogger(__name__)
 # Hide httpx logs
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-# Rate limiting
+# Rate limiting - share counters through Redis when available so every
+# gunicorn worker enforces the same limits. One fixed-window limit keeps
+# each check to a single counter increment instead of a sliding-window script
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
-    default_limits=["100 per day", "50 per hour"]
+    default_limits=["100 per day"],
+    storage_uri=os.getenv('REDIS_URL', 'memory://'),
+    strategy="fixed-window"
 )
 
+# Client IP headers set by the edge proxy, in order of preference, as their
+# WSGI environ keys so each lookup is one dict access
+_IP_HEADERS = ('HTTP_CF_CONNECTING_IP', 'HTTP_X_REAL_IP')
+
+def _client_ip():
+    """Get the real client IP, preferring headers set by the edge proxy"""
+    environ = request.environ
+    for key in _IP_HEADERS:
+        ip = environ.get(key)
+        if ip:
+            return ip
+    # X-Forwarded-For is already applied to remote_addr by ProxyFix
+    return request.remote_addr
+
+@app.before_request
+def _remember_client_ip():
+    g.real_ip = _client_ip()
+
+@app.after_request
+def _no_cache_headers(response):
+    # Pages are generated per request - never let browsers or proxies keep them
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    return response
+
+# Placeholder used to split the page template around streamed content
+_CONTENT_MARKER = '<!--infinite-web-content-->'
+
+@functools.lru_cache(maxsize=1)
+def _render_shell():
+    """Render the page template once and split it into the parts around the content"""
+    return tuple(render_template('index.html', content=_CONTENT_MARKER).split(_CONTENT_MARKER, 1))
+
+def _page_shell():
+    """Get the (before, after) template parts - re-rendered in debug so template edits show up"""
+    return _render_shell.__wrapped__() if app.debug else _render_shell()
+
+def _wrap_page(content):
+    """Wrap a content fragment in the page template"""
+    before, after = _page_shell()
+    return before + content + after
+
+def _page_html(content):
+    """Complete HTML documents go out as is, fragments get the template"""
+    return content if is_full_document(content) else _wrap_page(content)
+
+@functools.lru_cache(maxsize=256)
+def _compressed_page(content):
+    """Gzip a cached page once and reuse the bytes for every later hit.
+    
+    Keyed by the cached string itself, so hits on the same cache entry
+    hash and compare by identity instead of rescanning the page.
+    """
+    return gzip.compress(_page_html(content).encode(), compresslevel=6)
+
+def _page_response(content):
+    """Build the response for a finished page, pre-compressed when the client accepts gzip"""
+    # Parsed quality value - 0 when gzip is missing or refused with q=0
+    if not request.accept_encodings['gzip']:
+        return make_response(_page_html(content))
+    # Don't hold on to pages rendered from a template that may still change
+    body = _compressed_page.__wrapped__(content) if app.debug else _compressed_page(content)
+    response = make_response(body)
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def _stream_page(chunks, preload_from=None):
+    """Stream generated content inside the page template.
+    
+    Pages that get cached are generated, cached and preloaded from on the
+    background loop; only uncached ones pass preload_from to start
+    preloading their links here once they are complete.
+    """
+    chunks = iter(chunks)
+    parts = []
+    failed = False
+    try:
+        # Peek far enough to tell a complete HTML document from a fragment
+        for chunk in chunks:
+            parts.append(chunk)
+            if sum(len(part) for part in parts) >= 16:
+                break
+    except Exception:
+        parts, failed = [UNAVAILABLE_HTML], True
+    
+    head = ''.join(parts)
+    if is_full_document(head):
+        # Complete HTML document - send it as is
+        before, after = '', ''
+    else:
+        # Fragment - wrap it in the template
+        before, after = _page_shell()
+    yield before + head
+    
+    if not failed:
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        except Exception:
+            failed = True
+            yield UNAVAILABLE_HTML
+    yield after
+    
+    if not failed and preload_from is not None:
+        # Start preloading linked content in background if enabled
+        start_preloading(''.join(parts).strip(), preload_from)
+
+def _stream_response(chunks, preload_from=None):
+    """Send generated content to the client as it arrives instead of after the whole page is done"""
+    return Response(stream_with_context(_stream_page(chunks, preload_from)), mimetype='text/html')
+
 # Custom error handler for rate limit exceeded
 @app.errorhandler(429)
 def ratelimit_handler(e):
-    logger.warning(f"Rate limit exceeded for IP: {get_remote_address()}")
-    return render_template('index.html', 
-                         content="<h1>Service Temporarily Unavailable</h1><p>Our website is currently overloaded with requests. Please try again in a few minutes.</p><p>We appreciate your patience!</p>"), 429
+    # The limiter can reject before our before_request hook has run
+    logger.warning("Rate limit exceeded for IP: %s", g.get('real_ip') or _client_ip())
+    return _wrap_page("<h1>Service Temporarily Unavailable</h1><p>Our website is currently overloaded with requests. Please try again in a few minutes.</p><p>We appreciate your patience!</p>"), 429
+
+# Built once - favicon requests never need a fresh body
+_NO_CONTENT = ('', 204)
 
 @app.route('/favicon.ico')
 def favicon():
-    return '', 204  # No content
+    return _NO_CONTENT  # No content
 
-@app.route('/')
-def home():
-    # Check for query parameters and sanitize them
-    query_param = request.args.get('query') or request.args.get('prompt') or ''
-    for key, value in request.args.items():
-        if key not in ['query', 'prompt'] and value:
-            query_param = value
-            break
-    if not query_param:
-        query_param = next(iter(request.args.keys()), '') if request.args else ''
+@functools.lru_cache(maxsize=1024)
+def _resolve_path(raw_path):
+    """Sanitize a requested path and build its redirect page if it is too deep.
     
-    # Sanitize the query parameter
-    query_param = sanitize_input(query_param)
-    
-    path_display = f"/?{query_param}" if query_param else "/"
-    # Get the real IP from headers - try multiple methods
-    real_ip = None
-    if 'CF-Connecting-IP' in request.headers:
-        real_ip = request.headers['CF-Connecting-IP']
-    elif 'X-Forwarded-For' in request.headers:
-        # Get the last IP in the chain (original client)
-        ips = request.headers['X-Forwarded-For'].split(',')
-        real_ip = ips[-1].strip()
-    elif 'X-Real-IP' in request.headers:
-        real_ip = request.headers['X-Real-IP']
-    else:
-        real_ip = get_remote_address()
-    logger.info(f"Home route accessed: {path_display} from IP: {real_ip}")
+    Memoized because crawlers keep requesting the same deep paths.
+    """
+    path_info = sanitize_path(raw_path)
     
+    # Enforce maximum depth of 4 levels - redirect to simpler path if exceeded
+    if path_info.count('/') + 1 > 4:
+        # Take only the last segment as a simple redirect
+        simple_path = path_info.split('/')[-1]
+        return path_info, f"<h1>Path Too Deep</h1><p>Redirecting to: <a href='/{simple_path}'>{simple_path}</a></p><script>setTimeout(() => window.location.href='/{simple_path}', 2000);</script>"
+    return path_info, None
+
+# Served while a preload for the page is still generating - reloads once it lands
+_LOADING_HTML = """<h1>Generating this page...</h1><p>It will appear here in a moment.</p>
+<script>new EventSource('/_events?path={path}').onmessage = () => location.reload();</script>"""
+# How long one event stream stays open before the page reloads and checks again
+_EVENTS_MAX_WAIT = 120
+# Each open event stream holds a worker thread - cap how many one client can keep open
+_EVENTS_MAX_PER_IP = 4
+_open_event_streams = {}  # client IP -> open stream count
+_event_streams_lock = threading.Lock()
+
+def _serve(path_info, prompt_info=None):
+    """Serve a page from the cache, a finished preload, or a fresh generation"""
     # HOME should never be cached - always generate fresh content
-    if not query_param:
-        logger.info(f"GENERATING: HOME")
-        content = generate_content_with_ai(query_param)
+    if not path_info:
+        logger.info("GENERATING: HOME")
+        return _stream_response(stream_content_with_ai(path_info), path_info)
+    
+    # Try to get cached content first
+    content = get_cached_content(path_info)
+    
+    if content:
+        logger.info("CACHED: %s", path_info)
+    elif claim_generation(path_info):
+        logger.info("GENERATING: %s", path_info)
+        return _stream_response(generate_and_cache(path_info, prompt_info or path_info))
     else:
-        # Use query_param as cache key for non-home paths
-        cache_key = query_param
-        
-        # Try to get cached content first
-        cached_content = get_cached_content(cache_key)
-        
-        if cached_content:
-            logger.info(f"CACHED: {query_param}")
-            content = cached_content
-        else:
-            # Check if currently being preloaded
-            preload_content = wait_for_preload(cache_key)
-            if preload_content:
-                logger.info(f"PRELOAD READY: {query_param}")
-                content = preload_content
-            else:
-                logger.info(f"GENERATING: {query_param}")
-                content = generate_content_with_ai(query_param)
+        # Already generating for another request or as a preload - don't start a
+        # second one or park this thread on it, the browser waits on /_events instead
+        logger.info("PRELOAD PENDING: %s", path_info)
+        return make_response(_wrap_page(_LOADING_HTML.format(path=quote(path_info))))
     
     # Start preloading linked content in background if enabled
-    start_preloading(content, query_param)
+    start_preloading(content, path_info)
     
-    # Check if content is a complete HTML document
-    if content.strip().startswith('<!DOCTYPE html') or content.strip().startswith('<html'):
-        # Return complete HTML document directly
-        response = make_response(content)
-    else:
-        # Wrap fragment in template
-        response = make_response(render_template('index.html', content=content))
+    return _page_response(content)
+
+@app.route('/_events')
+@limiter.limit("120 per hour")
+def preload_events():
+    """Server-sent event stream that fires once a pending preload has finished or failed"""
+    path_info = sanitize_path(request.args.get('path', ''))
+    # Same identity the limiter uses - the edge proxy headers are client-controlled
+    client_ip = get_remote_address()
     
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    def events():
+        with _event_streams_lock:
+            if _open_event_streams.get(client_ip, 0) >= _EVENTS_MAX_PER_IP:
+                # Too many open already - have the browser reconnect later instead of holding a thread
+                yield 'retry: 5000\n\n'
+                return
+            _open_event_streams[client_ip] = _open_event_streams.get(client_ip, 0) + 1
+        try:
+            deadline = time.monotonic() + _EVENTS_MAX_WAIT
+            while is_preloading(path_info) and (remaining := deadline - time.monotonic()) > 0:
+                wait_for_preload(path_info, max_wait=min(15, remaining))
+                # Keep proxies from closing an idle stream
+                yield ': waiting\n\n'
+            yield 'data: ready\n\n'
+        finally:
+            with _event_streams_lock:
+                if _open_event_streams[client_ip] <= 1:
+                    del _open_event_streams[client_ip]
+                else:
+                    _open_event_streams[client_ip] -= 1
+    
+    return Response(events(), mimetype='text/event-stream')
+
+@app.route('/')
+def home():
+    # Check for query parameters - fall back to a bare key like /?gaming
+    args = request.args
+    query_param = args.get('query') or args.get('prompt') or next(iter(args.values()), '') or next(iter(args), '')
+    
+    # Sanitize the query parameter
+    query_param = sanitize_path(query_param)
+    
+    logger.info("Home route accessed: /%s%s from IP: %s", "?" if query_param else "", query_param, g.real_ip)
+    return _serve(query_param)
 
 @app.route('/<path:path_info>')
 def dynamic_page(path_info):
     # Sanitize path_info immediately
-    path_info = sanitize_input(path_info)
-    
-    # Enforce maximum depth of 4 levels - redirect to simpler path if exceeded
-    path_levels = path_info.count('/') + 1
-    if path_levels > 4:
-        logger.warning(f"Path too deep ({path_levels} levels): {path_info}")
-        # Take only the last segment as a simple redirect
-        simple_path = path_info.split('/')[-1]
-        return f"<h1>Path Too Deep</h1><p>Redirecting to: <a href='/{simple_path}'>{simple_path}</a></p><script>setTimeout(() => window.location.href='/{simple_path}', 2000);</script>"
-    # Get the real IP from headers - try multiple methods
-    real_ip = None
-    if 'CF-Connecting-IP' in request.headers:
-        real_ip = request.headers['CF-Connecting-IP']
-    elif 'X-Forwarded-For' in request.headers:
-        # Get the last IP in the chain (original client)
-        ips = request.headers['X-Forwarded-For'].split(',')
-        real_ip = ips[-1].strip()
-    elif 'X-Real-IP' in request.headers:
-        real_ip = request.headers['X-Real-IP']
-    else:
-        real_ip = get_remote_address()
-    logger.info(f"Dynamic page accessed: /{path_info} from IP: {real_ip}")
+    path_info, redirect_page = _resolve_path(path_info)
+    if redirect_page:
+        logger.warning("Path too deep (%d levels): %s", path_info.count('/') + 1, path_info)
+        return redirect_page
+    logger.info("Dynamic page accessed: /%s from IP: %s", path_info, g.real_ip)
     
     # Check if this is a subpage and provide context
     path_parts = path_info.split('/')
@@ -137,41 +276,8 @@ def dynamic_page(path_info):
         parent_topic = path_parts[0]
         subpage = '/'.join(path_parts[1:])
         context_prompt = f"This is a subpage '{subpage}' under the main topic '{parent_topic}'. Create content specifically for this subpage while relating it back to {parent_topic}."
-        full_path_info = f"{path_info} ({context_prompt})"
-    else:
-        full_path_info = path_info
-    
-    # Try to get cached content first
-    cached_content = get_cached_content(path_info)
-    
-    if cached_content:
-        logger.info(f"CACHED: {path_info}")
-        content = cached_content
-    else:
-        # Check if currently being preloaded, but don't wait too long
-        preload_content = wait_for_preload(path_info, max_wait=5)  # Only wait 5 seconds
-        if preload_content:
-            logger.info(f"PRELOAD READY: {path_info}")
-            content = preload_content
-        else:
-            logger.info(f"GENERATING: {path_info}")
-            content = generate_content_with_ai(full_path_info)
-    
-    # Start preloading linked content in background if enabled
-    start_preloading(content, path_info)
-    
-    # Check if content is a complete HTML document
-    if content.strip().startswith('<!DOCTYPE html') or content.strip().startswith('<html'):
-        # Return complete HTML document directly
-        response = make_response(content)
-    else:
-        # Wrap fragment in template
-        response = make_response(render_template('index.html', content=content))
-    
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+        return _serve(path_info, f"{path_info} ({context_prompt})")
+    return _serve(path_info)
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 3000))
@@ -1,98 +1,501 @@
 import os
 import time
+import asyncio
 import threading
 import logging
+from dataclasses import dataclass, field
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from ai_service import generate_content_with_ai, extract_navigation_links
+from ai_service import (API_TYPE, generate_content_async, stream_content_async, extract_navigation_links,
+                        run_async, submit_batch_async, get_batch_results_async)
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 PRELOAD_ENABLED = os.getenv('PRELOAD', 'False').lower() == 'true'
+# Send preloads through Gemini Batch Mode instead of the interactive endpoint
+PRELOAD_BATCH = os.getenv('PRELOAD_BATCH', 'False').lower() == 'true' and API_TYPE == 'gemini'
+BATCH_FLUSH_INTERVAL = 30  # seconds between batch submissions
+BATCH_POLL_INTERVAL = 30  # seconds between batch status checks
+BATCH_MAX_WAIT = 24 * 3600  # Batch Mode target turnaround
+# Interactive-endpoint preloads run on a fixed group of workers fed by a
+# bounded queue, so a burst of page views can't open dozens of parallel LLM requests
+PRELOAD_WORKERS = int(os.getenv('PRELOAD_WORKERS', 8))
+PRELOAD_QUEUE_SIZE = 256  # preloads beyond this are dropped, not queued
+CACHE_TTL = 3600  # Cache for 1 hour
+# Share the page cache and preload claims across gunicorn workers
+REDIS_URL = os.getenv('REDIS_URL')
+PRELOAD_CLAIM_TTL = 60  # seconds before an abandoned preload claim expires
+# Request-path generations stream pages of up to 16K tokens and can run for
+# minutes - their claims last longer and are refreshed while chunks arrive
+GENERATION_CLAIM_TTL = 180
+CLAIM_REFRESH_INTERVAL = 15  # seconds between claim refreshes during a generation
+# With Redis holding the shared copy, the in-process shards are a short-lived hot tier
+LOCAL_CACHE_TTL = 300 if REDIS_URL else CACHE_TTL
+# Total size of cached pages (in characters) before least recently used pages are evicted
+CACHE_MAX_SIZE = int(os.getenv('CACHE_MAX_SIZE', 256 * 1024 * 1024))
 
-# Global cache for preloaded content
-content_cache = {}
-cache_lock = threading.Lock()
+# Global cache for preloaded content, split into shards that each have their
+# own lock so independent paths never contend. TTLCache is not thread-safe, so
+# every access to a shard happens under its lock.
+NUM_SHARDS = 32
+cache_locks = [threading.Lock() for _ in range(NUM_SHARDS)]
+content_caches = [TTLCache(maxsize=CACHE_MAX_SIZE // NUM_SHARDS, ttl=LOCAL_CACHE_TTL, getsizeof=len)
+                  for _ in range(NUM_SHARDS)]
 # Track ongoing preload requests
-preload_status = {}  # path -> 'generating' | 'completed'
+preload_status = {}  # path -> PreloadEntry
+# Paths waiting for the next batch submission
+batch_buffer = []
+batch_lock = threading.Lock()
+# Paths waiting for a preload worker - only touched on the background loop
+preload_queue = asyncio.Queue(maxsize=PRELOAD_QUEUE_SIZE)
 
-def preload_content_async(path_info, depth=0):
-    """Generate content in background thread"""
-    # Prevent infinite recursion and bad paths
-    if depth > 0 or not path_info or 'favicon' in path_info or path_info.startswith('.'):
+if REDIS_URL:
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL)
+else:
+    redis_client = None
+
+@dataclass
+class PreloadEntry:
+    """An in-flight preload - waiters block on the event until it lands or fails"""
+    status: str  # 'generating' | 'batched'
+    event: threading.Event = field(default_factory=threading.Event)
+    started: float = field(default_factory=time.monotonic)
+    ttl: float = PRELOAD_CLAIM_TTL
+    
+    def is_pending(self):
+        """Whether this is a generation expected to land soon - stuck ones stop counting after the claim TTL"""
+        return self.status == 'generating' and time.monotonic() - self.started < self.ttl
+
+@dataclass
+class GenerationBuffer:
+    """Chunks of a claimed generation, filled on the background loop and read by the request that claimed it"""
+    chunks: list = field(default_factory=list)
+    done: bool = False
+    error: Exception = None
+    cond: threading.Condition = field(default_factory=threading.Condition)
+    
+    def append(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+    
+    def finish(self, error=None):
+        with self.cond:
+            self.done, self.error = True, error
+            self.cond.notify_all()
+    
+    def __iter__(self):
+        """Yield chunks as they arrive - a slow reader never holds up the generation"""
+        sent = 0
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(lambda: len(self.chunks) > sent or self.done, PRELOAD_CLAIM_TTL):
+                    raise TimeoutError("generation stalled")
+                chunks, done, error = self.chunks[sent:], self.done, self.error
+            sent += len(chunks)
+            yield from chunks
+            if done and sent == len(self.chunks):
+                if error:
+                    raise error
+                return
+
+def _shard(path_info):
+    """Get the index of the shard holding a path"""
+    return hash(path_info) & (NUM_SHARDS - 1)
+
+def _lock(path_info):
+    """Get the lock guarding a path's shard"""
+    return cache_locks[_shard(path_info)]
+
+def _finish(path_info):
+    """Forget an in-flight preload and wake its waiters - caller holds the path's lock"""
+    entry = preload_status.pop(path_info, None)
+    if entry:
+        entry.event.set()
+
+def _store_local(shard, path_info, content):
+    """Put a page in its shard - caller holds the shard's lock.
+    
+    A page bigger than a whole shard can't be cached in process; it is skipped
+    (it is still shared through Redis when that is configured).
+    """
+    cache = content_caches[shard]
+    if len(content) > cache.maxsize:
+        logger.warning("PAGE TOO LARGE TO CACHE LOCALLY: %s (%d chars)", path_info, len(content))
         return
+    cache[path_info] = content
+
+def _claim_shared(paths, status):
+    """Claim preloads for this worker in one round-trip - returns the paths we won.
     
-    # Check if already preloading or cached
-    with cache_lock:
-        if path_info in preload_status:
-            logger.info(f"ALREADY PRELOADING: {path_info}")
-            return
-        if path_info in content_cache:
-            logger.info(f"SKIP PRELOAD - CACHED: {path_info}")
+    Paths another worker is generating, or that it has already cached, are skipped.
+    """
+    ttl = BATCH_MAX_WAIT if status == 'batched' else PRELOAD_CLAIM_TTL
+    pipe = redis_client.pipeline(transaction=False)
+    for path_info in paths:
+        pipe.exists(f"c:{path_info}")
+        pipe.set(f"pl:{path_info}", status, nx=True, ex=ttl)
+    results = pipe.execute()
+    
+    won, cached = [], []
+    for path_info, exists, claimed in zip(paths, results[::2], results[1::2]):
+        if exists:
+            logger.info("SKIP PRELOAD - CACHED: %s", path_info)
+            if claimed:
+                cached.append(path_info)
+        elif claimed:
+            won.append(path_info)
+        else:
+            logger.info("ALREADY PRELOADING: %s", path_info)
+    if cached:
+        redis_client.delete(*[f"pl:{path_info}" for path_info in cached])
+    return won
+
+def _release(paths):
+    """Give up in-flight preloads that won't produce content"""
+    for path_info in paths:
+        with _lock(path_info):
+            _finish(path_info)
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for path_info in paths:
+                pipe.delete(f"pl:{path_info}")
+                pipe.publish(f"pl_done:{path_info}", 0)
+            pipe.execute()
+        except Exception as e:
+            # The shared claims expire on their own - don't let an outage take the caller down
+            logger.warning("SHARED RELEASE FAILED: %s", e)
+
+def enqueue_preloads(paths):
+    """Claim and queue preloads for several paths, taking each shard lock once"""
+    by_shard = {}
+    for path_info in paths:
+        # Prevent bad paths
+        if not path_info or 'favicon' in path_info or path_info.startswith('.'):
+            continue
+        by_shard.setdefault(_shard(path_info), []).append(path_info)
+    
+    status = 'batched' if PRELOAD_BATCH else 'generating'
+    claimed = []
+    for shard, shard_paths in by_shard.items():
+        # Check if already preloading or cached
+        with cache_locks[shard]:
+            for path_info in shard_paths:
+                if path_info in preload_status:
+                    logger.info("ALREADY PRELOADING: %s", path_info)
+                    continue
+                if path_info in content_caches[shard]:
+                    logger.info("SKIP PRELOAD - CACHED: %s", path_info)
+                    continue
+                preload_status[path_info] = PreloadEntry(status)
+                logger.info("PRELOADING: %s", path_info)
+                claimed.append(path_info)
+    
+    if claimed and redis_client:
+        # Other workers may already have these - keep only the ones we won
+        won = _claim_shared(claimed, status)
+        lost = set(claimed).difference(won)
+        for path_info in lost:
+            with _lock(path_info):
+                _finish(path_info)
+        claimed = won
+    
+    if not claimed:
+        return
+    if PRELOAD_BATCH:
+        with batch_lock:
+            batch_buffer.extend(claimed)
+    else:
+        run_async(_queue_preloads(claimed))
+
+async def _queue_preloads(paths):
+    """Hand claimed paths to the preload workers"""
+    for i, path_info in enumerate(paths):
+        try:
+            preload_queue.put_nowait(path_info)
+        except asyncio.QueueFull:
+            # Workers are far behind - give these up so the request path generates them
+            logger.warning("PRELOAD QUEUE FULL - dropping %d paths", len(paths) - i)
+            await asyncio.to_thread(_release, paths[i:])
             return
-        preload_status[path_info] = 'generating'
+
+async def _preload_worker():
+    """Generate queued preloads one at a time"""
+    while True:
+        path_info = await preload_queue.get()
+        try:
+            await _preload_one(path_info)
+        except Exception:
+            # Keep the worker alive for the next path whatever went wrong with this one
+            logger.exception("PRELOAD WORKER ERROR: %s", path_info)
+
+async def _preload_one(path_info):
+    """Generate and cache a single preloaded page"""
+    try:
+        content = await generate_content_async(path_info)
+        
+        # Cache writes may go over the network - keep them off the event loop
+        await asyncio.to_thread(cache_content, path_info, content)
+        logger.info("PRELOAD COMPLETED AND CACHED: %s", path_info)
+                    
+    except Exception as e:
+        logger.error("PRELOAD FAILED: %s", path_info)
+        await asyncio.to_thread(_release, [path_info])
+
+async def _flush_batches():
+    """Periodically submit buffered preloads as a single Gemini batch job"""
+    while True:
+        await asyncio.sleep(BATCH_FLUSH_INTERVAL)
+        with batch_lock:
+            paths = batch_buffer[:]
+            batch_buffer.clear()
+        if not paths:
+            continue
         
-    def generate():
         try:
-            content = generate_content_with_ai(path_info)
-            
-            with cache_lock:
-                content_cache[path_info] = {
-                    'content': content,
-                    'timestamp': time.time(),
-                    'expires_at': time.time() + 3600  # Cache for 1 hour
-                }
-                preload_status[path_info] = 'completed'
-                logger.info(f"PRELOAD COMPLETED AND CACHED: {path_info}")
-                        
+            name = await submit_batch_async(paths)
+            logger.info("BATCH SUBMITTED: %s (%d paths)", name, len(paths))
+            asyncio.create_task(_poll_batch(name, paths))
+        except Exception:
+            logger.exception("BATCH SUBMIT FAILED: %d paths", len(paths))
+            # Doesn't raise on Redis errors, so the flusher keeps running for later batches
+            await asyncio.to_thread(_release, paths)
+
+async def _poll_batch(name, paths):
+    """Wait for a batch job to finish and cache its results"""
+    deadline = time.time() + BATCH_MAX_WAIT
+    results = {}
+    while time.time() < deadline:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        try:
+            results = await get_batch_results_async(name)
         except Exception as e:
-            logger.error(f"PRELOAD FAILED: {path_info}")
-            with cache_lock:
-                if path_info in preload_status:
-                    del preload_status[path_info]
+            # Transient status errors - keep polling
+            logger.warning("BATCH POLL FAILED: %s: %s", name, e)
+            continue
+        if results is not None:
+            break
     
-    threading.Thread(target=generate, daemon=True).start()
+    results = results or {}
+    # Results for the whole job arrive together - write them in one go
+    await asyncio.to_thread(cache_contents, {path_info: results[path_info] for path_info in paths if path_info in results})
+    await asyncio.to_thread(_release, [path_info for path_info in paths if path_info not in results])
+    logger.info("BATCH COMPLETED AND CACHED: %s (%d of %d paths)", name, len(results), len(paths))
+
+if PRELOAD_ENABLED and PRELOAD_BATCH:
+    run_async(_flush_batches())
+elif PRELOAD_ENABLED:
+    for _ in range(PRELOAD_WORKERS):
+        run_async(_preload_worker())
 
 def get_cached_content(path_info):
     """Get content from cache if available and not expired"""
-    with cache_lock:
-        if path_info in content_cache:
-            cache_entry = content_cache[path_info]
-            if time.time() < cache_entry['expires_at']:
-                return cache_entry['content']
-            else:
-                # Remove expired content
-                del content_cache[path_info]
-                if path_info in preload_status:
-                    del preload_status[path_info]
-    return None
+    # Expired pages are dropped by the TTLCache itself
+    shard = _shard(path_info)
+    with cache_locks[shard]:
+        content = content_caches[shard].get(path_info)
+    
+    if content is None and redis_client:
+        value = redis_client.get(f"c:{path_info}")
+        if value is not None:
+            content = value.decode()
+            with cache_locks[shard]:
+                _store_local(shard, path_info, content)
+    return content
+
+def cache_contents(items):
+    """Store several {path: content} entries, taking each shard lock once"""
+    if not items:
+        return
+    if redis_client:
+        # One round-trip for the whole set, and wake waiters in other workers
+        pipe = redis_client.pipeline(transaction=False)
+        for path_info, content in items.items():
+            pipe.setex(f"c:{path_info}", CACHE_TTL, content)
+            pipe.delete(f"pl:{path_info}")
+            pipe.publish(f"pl_done:{path_info}", 1)
+        pipe.execute()
+    
+    by_shard = {}
+    for path_info, content in items.items():
+        by_shard.setdefault(_shard(path_info), []).append((path_info, content))
+    
+    for shard, entries in by_shard.items():
+        with cache_locks[shard]:
+            for path_info, content in entries:
+                _store_local(shard, path_info, content)
+                _finish(path_info)
+
+def cache_content(path_info, content):
+    """Store generated content so later visits and waiters reuse it"""
+    cache_contents({path_info: content})
 
 def wait_for_preload(path_info, max_wait=5):
     """Wait for ongoing preload to complete"""
-    start_time = time.time()
-    
-    while time.time() - start_time < max_wait:
-        with cache_lock:
-            if path_info not in preload_status:
-                # Not being preloaded
-                return None
-            
-            current_status = preload_status[path_info]
-            
-            if current_status == 'completed':
-                # Preload completed, try to get cached content
-                cached_content = get_cached_content(path_info)
-                if cached_content:
-                    return cached_content
+    with _lock(path_info):
+        entry = preload_status.get(path_info)
+    
+    if entry is None:
+        # Not being preloaded here - maybe by another worker
+        return _wait_for_shared_preload(path_info, max_wait) if redis_client else None
+    
+    if entry.status == 'batched':
+        # Batch jobs take minutes - don't hold the request for them
+        return None
+    
+    # Woken as soon as the preload lands or fails - no polling
+    if entry.event.wait(max_wait):
+        return get_cached_content(path_info)
+    
+    logger.warning("TIMEOUT waiting for preload: %s", path_info)
+    return None
+
+def is_preloading(path_info):
+    """Check whether a preload that will finish soon is running for this path.
+    
+    Batch Mode preloads don't count - they can take hours.
+    """
+    with _lock(path_info):
+        entry = preload_status.get(path_info)
+    if entry is not None:
+        return entry.is_pending()
+    return bool(redis_client) and redis_client.get(f"pl:{path_info}") == b'generating'
+
+def claim_generation(path_info):
+    """Claim a request-path generation so concurrent misses for the same page share it.
+    
+    Returns False if the page is already generating here or in another worker.
+    Pages waiting on Batch Mode are taken over, so concurrent misses for them
+    share one generation too - the batch result landing later is harmless.
+    """
+    with _lock(path_info):
+        entry = preload_status.get(path_info)
+        if entry is not None and entry.status != 'batched':
+            if entry.is_pending():
+                return False
+            # Stuck past the claim TTL - wake its waiters and take over
+            logger.warning("STALE GENERATION CLAIM: %s", path_info)
+            _finish(path_info)
+        if redis_client and not _claim_shared_generation(path_info):
+            return False
+        preload_status[path_info] = PreloadEntry('generating', ttl=GENERATION_CLAIM_TTL)
+    return True
+
+def _claim_shared_generation(path_info):
+    """Claim a request-path generation across workers, taking over a Batch Mode claim"""
+    key = f"pl:{path_info}"
+    if redis_client.set(key, 'generating', nx=True, ex=GENERATION_CLAIM_TTL):
+        return True
+    # Only swap out a batched claim - anything else means another worker is generating
+    with redis_client.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) != b'batched':
+                return False
+            pipe.multi()
+            pipe.set(key, 'generating', ex=GENERATION_CLAIM_TTL)
+            pipe.execute()
+        except redis.WatchError:
+            # Someone else changed the claim first
+            return False
+    return True
+
+def generate_and_cache(path_info, prompt_info):
+    """Run a claimed generation on the background loop and cache it when it finishes.
+    
+    Returns a buffer the claiming request streams from. The generation and the
+    cache write don't depend on that request reading, so a slow or departed
+    client can't hold the page up for everyone waiting on it.
+    """
+    buffer = GenerationBuffer()
+    run_async(_generate_into(buffer, path_info, prompt_info))
+    return buffer
+
+async def _generate_into(buffer, path_info, prompt_info):
+    """Fill a generation buffer from the provider stream, then cache the page and preload its links"""
+    loop = asyncio.get_running_loop()
+    refreshed = loop.time()
+    try:
+        async for chunk in stream_content_async(prompt_info):
+            buffer.append(chunk)
+            if loop.time() - refreshed >= CLAIM_REFRESH_INTERVAL:
+                # Still making progress - don't let waiters treat the claim as stale
+                refreshed = loop.time()
+                await asyncio.to_thread(_refresh_generation, path_info)
+    except Exception as e:
+        buffer.finish(e)
+        await asyncio.to_thread(release_generation, path_info)
+        return
+    
+    buffer.finish()
+    content = ''.join(buffer.chunks).strip()
+    try:
+        # Cache writes may go over the network - keep them off the event loop
+        await asyncio.to_thread(cache_content, path_info, content)
+    except Exception:
+        # Nobody awaits this task - log here and free the page for the next request
+        logger.exception("CACHE WRITE FAILED: %s", path_info)
+        await asyncio.to_thread(release_generation, path_info)
+        return
+    try:
+        await asyncio.to_thread(start_preloading, content, path_info)
+    except Exception:
+        logger.exception("PRELOAD START FAILED: %s", path_info)
+
+def _refresh_generation(path_info):
+    """Extend a running generation's claim, here and in Redis"""
+    with _lock(path_info):
+        entry = preload_status.get(path_info)
+        if entry is not None and entry.status == 'generating':
+            entry.started = time.monotonic()
+    if redis_client:
+        try:
+            redis_client.expire(f"pl:{path_info}", GENERATION_CLAIM_TTL)
+        except Exception as e:
+            logger.warning("CLAIM REFRESH FAILED: %s", e)
+
+def release_generation(path_info):
+    """Give up a claimed generation that failed or was abandoned, waking anyone waiting on it"""
+    with _lock(path_info):
+        entry = preload_status.get(path_info)
+        if entry is None or entry.status != 'generating':
+            return
+        _finish(path_info)
+    if redis_client:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.delete(f"pl:{path_info}")
+            pipe.publish(f"pl_done:{path_info}", 0)
+            pipe.execute()
+        except Exception as e:
+            # The shared claim expires on its own
+            logger.warning("SHARED RELEASE FAILED: %s", e)
+
+def _wait_for_shared_preload(path_info, max_wait):
+    """Wait for a preload running in another worker to publish its result"""
+    status = redis_client.get(f"pl:{path_info}")
+    if status is None or status == b'batched':
+        return None
+    
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(f"pl_done:{path_info}")
+        # It may have finished before we subscribed
+        if redis_client.get(f"pl:{path_info}") is None:
+            return get_cached_content(path_info)
         
-        time.sleep(0.1)  # Wait 100ms before checking again
+        deadline = time.time() + max_wait
+        while (remaining := deadline - time.time()) > 0:
+            if pubsub.get_message(timeout=remaining):
+                return get_cached_content(path_info)
+    finally:
+        pubsub.close()
     
-    # Timeout - clean up and give up
-    logger.warning(f"TIMEOUT waiting for preload: {path_info}")
-    with cache_lock:
-        if path_info in preload_status:
-            del preload_status[path_info]
+    logger.warning("TIMEOUT waiting for preload: %s", path_info)
     return None
 
 def start_preloading(content, current_path=""):
@@ -100,10 +503,7 @@ def start_preloading(content, current_path=""):
     if PRELOAD_ENABLED and content:
         links = extract_navigation_links(content, current_path)
         if links:
-            logger.info(f"FOUND LINKS in {current_path or 'HOME'}: {', '.join(links)}")
-            for link in links:
-                if get_cached_content(link) is None:  # Only preload if not already cached
-                    logger.info(f"PRELOADING: {link}")
-                    preload_content_async(link, depth=0)
-                else:
-                    logger.info(f"ALREADY CACHED: {link}")
\ No newline at end of file
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("FOUND LINKS in %s: %s", current_path or 'HOME', ', '.join(links))
+            # Cached and in-flight links are skipped while claiming
+            enqueue_preloads(links)
@@ -0,0 +1,11 @@
+import os
+
+# Requests spend almost all their time waiting on the LLM, so each worker
+# runs a pool of threads instead of serving one request at a time.
+# Workers default to 1 because without REDIS_URL the page cache lives in process memory.
+bind = f"0.0.0.0:{os.getenv('PORT', 3000)}"
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+accesslog = '-'
+errorlog = '-'
@@ -0,0 +1,34 @@
+import re
+import html
+
+# Patterns used on every request - compiled once at import
+_SCRIPT_RE = re.compile(r'<script[^>]*>.*?</script>', re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r'<[^>]*>')
+_JS_RE = re.compile(r'javascript:', re.IGNORECASE)
+# Start of a complete HTML document, after any leading whitespace
+_DOCUMENT_RE = re.compile(r'\s*<(?:!doctype html|html)', re.IGNORECASE)
+# Anything that isn't a word character, space, dot, dash or slash
+_UNSAFE_PATH_RE = re.compile(r'[^\w ./\-]')
+
+def sanitize_input(text):
+    """Sanitize user input to prevent XSS attacks"""
+    if not text:
+        return ""
+    # Remove script blocks, then any remaining HTML tags
+    cleaned = _SCRIPT_RE.sub('', text)
+    cleaned = _TAG_RE.sub('', cleaned)
+    # Additional safety: remove script-like URLs and escape what is left
+    cleaned = _JS_RE.sub('', cleaned)
+    return html.escape(cleaned, quote=True).strip()
+
+def sanitize_path(text):
+    """Reduce a URL path or query to safe characters for cache keys and prompts"""
+    if not text:
+        return ""
+    # Whitelist instead of stripping HTML - paths never need markup
+    return _UNSAFE_PATH_RE.sub('', text)[:200].strip()
+
+def is_full_document(content):
+    """Check whether content is a complete HTML document rather than a fragment"""
+    # Anchored match scans in place - no stripped or lowered copy of the page
+    return _DOCUMENT_RE.match(content) is not None